@@ -1,5 +1,8 @@
 from trailbase import (
     EVENT_ERROR_STATUS_FORBIDDEN,
+    And,
+    DefaultTransport,
+    Or,
     ErrorEvent,
     parseEvent,
     Client,
@@ -10,6 +13,7 @@ from trailbase import (
     UpdateEvent,
     DeleteEvent,
     RecordId,
+    Tokens,
     JSON,
     JSON_OBJECT,
     EVENT,
@@ -17,61 +21,86 @@ from trailbase import (
 
 import httpx
 import json
+import jwt
 import logging
 import mintotp  # type: ignore
 import os
 import pytest
+import queue
+import shutil
+import signal
 import subprocess
+import tempfile
+import threading
 
-from time import time, sleep
-from typing import List, cast
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, time, sleep
+from typing import Callable, cast
 
 logging.basicConfig(level=logging.DEBUG)
 
-port = 4007
+# Under pytest-xdist, every worker runs its own server on its own port against its own depot copy.
+_xdist_worker = os.environ.get("PYTEST_XDIST_WORKER")
+
+port = 4007 + (int(_xdist_worker.removeprefix("gw")) if _xdist_worker is not None else 0)
 address = f"127.0.0.1:{port}"
 site = f"http://{address}"
 
+# Generous since it includes building the server on a cold cache.
+_STARTUP_TIMEOUT = 600.0
+
 
 class TrailBaseFixture:
     process: None | subprocess.Popen[bytes]
+    depot_copy: str | None = None
 
     def __init__(self) -> None:
         cwd = os.getcwd()
         traildepot = "../testfixture" if cwd.endswith("python") else "client/testfixture"
 
-        logger.info("Building TrailBase")
-        build = subprocess.run(["cargo", "build"])
-        assert build.returncode == 0, f"{build.stderr}"
-
-        logger.info("Starting TrailBase")
-        self.process = subprocess.Popen(
-            [
-                "cargo",
-                "run",
-                "--",
-                "--data-dir",
-                traildepot,
-                "run",
-                "-a",
-                address,
-                "--runtime-threads",
-                "1",
-            ]
-        )
-
-        client = httpx.Client()
-        for _ in range(100):
-            try:
-                response = client.get(f"http://{address}/api/healthcheck")
-                if response.status_code == 200:
-                    return
-            except Exception:
-                pass
-
-            sleep(0.5)
-
-        logger.error("Failed ot start TrailBase")
+        try:
+            if _xdist_worker is not None:
+                # Avoid SQLite lock contention between workers. State is recreated from migrations.
+                self.depot_copy = tempfile.mkdtemp(prefix=f"traildepot-{_xdist_worker}-")
+                shutil.copytree(
+                    traildepot,
+                    self.depot_copy,
+                    dirs_exist_ok=True,
+                    ignore=shutil.ignore_patterns("data", "backups", "uploads"),
+                )
+                traildepot = self.depot_copy
+
+            # NOTE: `cargo run` builds as needed, thus startup includes build time. Build failures
+            # surface as an early process exit below.
+            logger.info("Building & starting TrailBase")
+            self.process = subprocess.Popen(
+                [
+                    "cargo",
+                    "run",
+                    "--",
+                    "--data-dir",
+                    traildepot,
+                    "run",
+                    "-a",
+                    address,
+                    "--runtime-threads",
+                    "1",
+                ]
+            )
+
+            ready = threading.Event()
+            threading.Thread(target=_await_healthy, args=(self.process, ready), daemon=True).start()
+
+            # Also woken up early if the server process exits.
+            if not ready.wait(timeout=_STARTUP_TIMEOUT):
+                logger.error("Failed ot start TrailBase")
+            elif (returncode := self.process.poll()) is not None:
+                raise RuntimeError(f"TrailBase exited during startup with code {returncode}")
+        except BaseException:
+            # `shutdown` won't be called for a fixture that failed to start.
+            if self.depot_copy is not None:
+                shutil.rmtree(self.depot_copy, ignore_errors=True)
+            raise
 
     def isUp(self) -> bool:
         p = self.process
@@ -80,10 +109,41 @@ class TrailBaseFixture:
     def shutdown(self) -> None:
         p = self.process
         if p is not None:
-            p.send_signal(9)
-            p.wait()
+            # Give the server a chance to shut down cleanly, e.g. checkpoint SQLite's WAL, before
+            # resorting to SIGKILL.
+            p.send_signal(signal.SIGTERM)
+            try:
+                p.wait(timeout=2.0)
+            except subprocess.TimeoutExpired:
+                p.send_signal(signal.SIGKILL)
+                p.wait()
             assert isinstance(p.returncode, int)
 
+        if self.depot_copy is not None:
+            shutil.rmtree(self.depot_copy, ignore_errors=True)
+
+
+def _await_healthy(process: subprocess.Popen[bytes], ready: threading.Event) -> None:
+    # Poll with a single keep-alive client and exponential backoff, capped at 0.5s. HEAD skips the
+    # response body. Signals `ready` once healthy or, to fail fast, when the server process exits.
+    with httpx.Client(base_url=site, timeout=httpx.Timeout(0.25, connect=0.25)) as client:
+        deadline = monotonic() + _STARTUP_TIMEOUT
+        i = 0
+        while monotonic() < deadline:
+            if process.poll() is not None:
+                ready.set()
+                return
+
+            try:
+                if client.head("/api/healthcheck").status_code == 200:
+                    ready.set()
+                    return
+            except Exception:
+                pass
+
+            sleep(min(0.5, 0.025 * 2**i))
+            i += 1
+
 
 @pytest.fixture(scope="session")
 def trailbase():
@@ -98,6 +158,14 @@ def connect() -> Client:
     return client
 
 
+@pytest.fixture(scope="session")
+def client(trailbase: TrailBaseFixture):
+    """Admin client shared across tests to only log in once per session."""
+    client = connect()
+    yield client
+    client.logout()
+
+
 def test_authentication(trailbase: TrailBaseFixture):
     assert trailbase.isUp()
 
@@ -171,10 +239,21 @@ def test_otp_auth(trailbase: TrailBaseFixture):
     assert exec.value.status == 401
 
 
-def test_records(trailbase: TrailBaseFixture):
+def _col(records: list[JSON_OBJECT], column: str) -> list[JSON]:
+    return [record[column] for record in records]
+
+
+def _get(obj: JSON, *keys: str) -> JSON:
+    """Walk nested objects along `keys`, yielding None for missing keys."""
+    for key in keys:
+        assert isinstance(obj, dict)
+        obj = obj.get(key)
+    return obj
+
+
+def test_records(trailbase: TrailBaseFixture, client: Client):
     assert trailbase.isUp()
 
-    client = connect()
     api = client.records("simple_strict_table")
 
     now = int(time())
@@ -182,142 +261,116 @@ def test_records(trailbase: TrailBaseFixture):
         f"python client test 0: =?&{now}",
         f"python client test 1: =?&{now}",
     ]
-    ids: List[RecordId] = []
-    for msg in messages:
-        ids.append(api.create({"text_not_null": msg}))
-
-    if True:
-        bulk_ids = api.create_bulk(
-            [
-                {"text_not_null": "python bulk test 0"},
-                {"text_not_null": "python bulk test 1"},
-            ]
-        )
-        assert len(bulk_ids) == 2
-
-    if True:
-        response = api.list(
-            filters=[Filter("text_not_null", messages[0])],
-        )
-        records = response.records
-        assert len(records) == 1
-        assert records[0]["text_not_null"] == messages[0]
-
-    if True:
-        recordsAsc = api.list(
-            order=["+text_not_null"],
-            filters=[Filter(column="text_not_null", value=f"% =?&{now}", op=CompareOp.LIKE)],
-            count=True,
-        )
-
-        assert recordsAsc.total_count == 2
-        assert [el["text_not_null"] for el in recordsAsc.records] == messages
-
-        recordsDesc = api.list(
-            order=["-text_not_null"],
-            filters=[Filter(column="text_not_null", value=f"%{now}", op=CompareOp.LIKE)],
-        )
-
-        assert [el["text_not_null"] for el in recordsDesc.records] == list(reversed(messages))
-
-    if True:
-        record = api.read(ids[0])
-        assert record["text_not_null"] == messages[0]
-
-        record = api.read(ids[1])
-        assert record["text_not_null"] == messages[1]
-
-    if True:
-        updatedMessage = f"python client updated test 0: {now}"
-        api.update(ids[0], {"text_not_null": updatedMessage})
-        record = api.read(ids[0])
-        assert record["text_not_null"] == updatedMessage
-
-    if True:
-        api.delete(ids[0])
-
-        with pytest.raises(FetchException):
-            api.read(ids[0])
-
-
-def test_expand_foreign_records(trailbase: TrailBaseFixture):
+    # Matches the `messages` above but not the bulk records created below.
+    test_messages = Filter(column="text_not_null", value=f"% =?&{now}", op=CompareOp.LIKE)
+
+    ids: list[RecordId] = api.create_bulk([{"text_not_null": msg} for msg in messages])
+
+    bulk_ids = api.create_bulk(
+        [
+            {"text_not_null": "python bulk test 0"},
+            {"text_not_null": "python bulk test 1"},
+        ]
+    )
+    assert len(bulk_ids) == 2
+
+    response = api.list(
+        filters=[Filter("text_not_null", messages[0])],
+    )
+    records = response.records
+    assert len(records) == 1
+    assert records[0]["text_not_null"] == messages[0]
+
+    recordsAsc = api.list(
+        order=["+text_not_null"],
+        filters=[test_messages],
+        count=True,
+    )
+
+    assert recordsAsc.total_count == 2
+    assert _col(recordsAsc.records, "text_not_null") == messages
+
+    records = api.read_many([ids[0], ids[1]])
+    assert _col(records, "text_not_null") == messages
+
+    updatedMessage = f"python client updated test 0: {now}"
+    api.update(ids[0], {"text_not_null": updatedMessage})
+    record = api.read(ids[0])
+    assert record["text_not_null"] == updatedMessage
+
+    api.delete(ids[0])
+
+    with pytest.raises(FetchException):
+        api.read(ids[0])
+
+
+def test_expand_foreign_records(trailbase: TrailBaseFixture, client: Client):
     assert trailbase.isUp()
 
-    client = connect()
     api = client.records("comment")
 
-    def get_nested(obj: JSON_OBJECT, k0: str, k1: str) -> JSON | None:
-        x = obj[k0]
-        assert type(x) is dict
-        return x.get(k1)
+    # The plain and the expanded read are independent, so issue them concurrently.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        plain = executor.submit(api.read, 1)
+        expanded = executor.submit(api.read, 1, expand=["post"])
 
-    if True:
-        comment = api.read(1)
+    comment = plain.result()
 
-        assert comment.get("id") == 1
-        assert comment.get("body") == "first comment"
-        assert get_nested(comment, "author", "id") != ""
-        assert get_nested(comment, "author", "data") is None
-        assert get_nested(comment, "post", "id") != ""
+    assert comment.get("id") == 1
+    assert comment.get("body") == "first comment"
+    assert _get(comment, "author", "id") != ""
+    assert _get(comment, "author", "data") is None
+    assert _get(comment, "post", "id") != ""
 
-    if True:
-        comment = api.read(1, expand=["post"])
+    comment = expanded.result()
 
-        assert comment.get("id") == 1
-        assert comment.get("body") == "first comment"
-        assert get_nested(comment, "author", "data") is None
+    assert comment.get("id") == 1
+    assert comment.get("body") == "first comment"
+    assert _get(comment, "author", "data") is None
 
-        x = get_nested(comment, "post", "data")
-        assert type(x) is dict
-        assert x.get("title") == "first post"
+    assert _get(comment, "post", "data", "title") == "first post"
 
-    if True:
-        comments = api.list(
-            expand=["author", "post"],
-            order=["-id"],
-            limit=1,
-            count=True,
-        )
+    comments = api.list(
+        expand=["author", "post"],
+        order=["-id"],
+        limit=1,
+        count=True,
+    )
 
-        assert comments.total_count == 2
-        assert len(comments.records) == 1
+    assert comments.total_count == 2
+    assert len(comments.records) == 1
 
-        comment = comments.records[0]
+    comment = comments.records[0]
 
-        assert comment.get("id") == 2
-        assert comment.get("body") == "second comment"
+    assert comment.get("id") == 2
+    assert comment.get("body") == "second comment"
 
-        x = get_nested(comment, "post", "data")
-        assert type(x) is dict
-        assert x.get("title") == "first post"
+    assert _get(comment, "post", "data", "title") == "first post"
 
-        y = get_nested(comment, "author", "data")
-        assert type(y) is dict
-        assert y.get("name") == "SecondUser"
+    assert _get(comment, "author", "data", "name") == "SecondUser"
 
-    if True:
-        comments = api.list(
-            expand=["author", "post"],
-            order=["-id"],
-            limit=2,
-        )
+    comments = api.list(
+        expand=["author", "post"],
+        order=["-id"],
+        limit=2,
+    )
 
-        assert len(comments.records) == 2
+    assert len(comments.records) == 2
 
-        first = comments.records[0]
-        assert first.get("id") == 2
-        second = comments.records[1]
-        assert second.get("id") == 1
+    first = comments.records[0]
+    assert first.get("id") == 2
+    second = comments.records[1]
+    assert second.get("id") == 1
 
-        offset_comments = api.list(
-            expand=["author", "post"],
-            order=["-id"],
-            limit=1,
-            offset=1,
-        )
+    offset_comments = api.list(
+        expand=["author", "post"],
+        order=["-id"],
+        limit=1,
+        offset=1,
+    )
 
-        assert len(offset_comments.records) == 1
-        assert second == offset_comments.records[0]
+    assert len(offset_comments.records) == 1
+    assert second == offset_comments.records[0]
 
 
 def test_parse_event():
@@ -352,14 +405,30 @@ def test_parse_event():
     assert update_event.seq == 4
 
 
-def test_subscriptions(trailbase: TrailBaseFixture):
+def test_subscriptions(trailbase: TrailBaseFixture, client: Client):
     assert trailbase.isUp()
 
-    client = connect()
     api = client.records("simple_strict_table")
 
+    # NOTE: Registration is eager, i.e. the subscription is established before `subscribe_all`
+    # returns.
     table_subscription = api.subscribe_all()
 
+    received: queue.Queue[EVENT] = queue.Queue()
+
+    def receive() -> None:
+        # Consume in the background, so that missing events fail the test rather than hang it.
+        count = 0
+        for ev in table_subscription:
+            received.put(ev)
+            count += 1
+            if count == 3:
+                break
+
+        table_subscription.close()
+
+    threading.Thread(target=receive, daemon=True).start()
+
     now = int(time())
     create_message = f"python client subscription test 0: =?&{now}"
     id = api.create({"text_not_null": create_message})
@@ -369,13 +438,7 @@ def test_subscriptions(trailbase: TrailBaseFixture):
 
     api.delete(id)
 
-    events: List[EVENT] = []
-    for ev in table_subscription:
-        events.append(ev)
-        if len(events) == 3:
-            break
-
-    table_subscription.close()
+    events = [received.get(timeout=5.0) for _ in range(3)]
 
     ev0 = events[0]
     assert type(ev0) is InsertEvent
@@ -411,4 +474,151 @@ def test_filter_is_not_null_factory():
     assert f.op is CompareOp.IS_NOT_NULL
 
 
+def _mock_transport(
+    respond: Callable[[httpx.Request], httpx.Response],
+) -> tuple[DefaultTransport, list[httpx.Request]]:
+    """Transport answering with `respond` instead of a server, plus the list of requests it got."""
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return respond(request)
+
+    return DefaultTransport(site, httpx.Client(transport=httpx.MockTransport(handler))), requests
+
+
+def _mock_client(
+    respond: Callable[[httpx.Request], httpx.Response], tokens: Tokens | None = None
+) -> tuple[Client, list[httpx.Request]]:
+    transport, requests = _mock_transport(respond)
+    return Client(site, tokens=tokens, transport=transport), requests
+
+
+def test_list_nested_filter_params():
+    client, requests = _mock_client(lambda _: httpx.Response(200, json={"records": []}))
+    api = client.records("table")
+
+    api.list(
+        filters=[
+            Filter("col0", "val0"),
+            And(
+                [
+                    Filter("col1", "1", op=CompareOp.GREATER_THAN),
+                    Or([Filter("col2", "%x", op=CompareOp.LIKE), Filter.is_null("col3")]),
+                ]
+            ),
+        ]
+    )
+
+    assert len(requests) == 1
+    assert requests[0].url.params.multi_items() == [
+        ("filter[col0]", "val0"),
+        ("filter[$and][0][col1][$gt]", "1"),
+        ("filter[$and][1][$or][0][col2][$like]", "%x"),
+        ("filter[$and][1][$or][1][col3][$is]", "NULL"),
+    ]
+
+
+def test_transport_sets_json_content_type():
+    transport, requests = _mock_transport(lambda _: httpx.Response(200))
+
+    transport.fetch("api/test", method="POST", body={"a": 1})
+    assert requests[-1].headers["Content-Type"] == "application/json"
+    assert json.loads(requests[-1].content) == {"a": 1}
+
+    transport.fetch("api/test", method="POST", headers={"content-type": "text/plain"}, body="x")
+    assert requests[-1].headers.get_list("Content-Type") == ["text/plain"]
+
+    transport.fetch("api/test")
+    assert "Content-Type" not in requests[-1].headers
+
+
+def test_read_many():
+    client, requests = _mock_client(
+        lambda _: httpx.Response(200, json={"records": [{"id": 3, "v": "c"}, {"id": 1, "v": "a"}]})
+    )
+    api = client.records("table")
+
+    assert api.read_many([]) == []
+    assert len(requests) == 0
+
+    records = api.read_many([1, RecordId("2"), 3, "1"])
+    assert records == [{"id": 1, "v": "a"}, {"id": 3, "v": "c"}, {"id": 1, "v": "a"}]
+
+    assert len(requests) == 1
+    assert requests[0].url.params.multi_items() == [
+        ("limit", "3"),
+        ("filter[$or][0][id]", "1"),
+        ("filter[$or][1][id]", "2"),
+        ("filter[$or][2][id]", "3"),
+    ]
+
+
+def _encode_test_token(sub: str) -> str:
+    claims = {
+        "sub": sub,
+        "iat": int(time()),
+        "exp": int(time()) + 3600,
+        "email": None,
+        "username": None,
+        "csrf_token": "csrf",
+    }
+    return jwt.encode(claims, "0123456789abcdef0123456789abcdef", algorithm="HS256")
+
+
+def test_fetch_refreshes_and_retries_on_unauthorized():
+    stale = _encode_test_token("stale")
+    fresh = _encode_test_token("fresh")
+
+    def respond(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/api/auth/v1/refresh":
+            return httpx.Response(200, json={"auth_token": fresh})
+        if request.headers["Authorization"] != f"Bearer {fresh}":
+            return httpx.Response(401)
+        return httpx.Response(200, json={"id": 1})
+
+    client, requests = _mock_client(respond, Tokens(stale, "refresh", None))
+
+    assert client.records("table").read(1) == {"id": 1}
+    assert [r.url.path for r in requests] == [
+        "/api/records/v1/table/1",
+        "/api/auth/v1/refresh",
+        "/api/records/v1/table/1",
+    ]
+
+    tokens = client.tokens()
+    assert tokens is not None and tokens.auth == fresh and tokens.refresh == "refresh"
+
+
+def test_failed_login_is_not_retried():
+    def respond(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/api/auth/v1/refresh":
+            return httpx.Response(200, json={"auth_token": _encode_test_token("fresh")})
+        return httpx.Response(401)
+
+    client, requests = _mock_client(respond, Tokens(_encode_test_token("user"), "refresh", None))
+
+    with pytest.raises(FetchException) as exec:
+        client.login("alice@trailbase.io", "wrong")
+
+    assert exec.value.status == 401
+    assert [r.url.path for r in requests] == ["/api/auth/v1/login"]
+
+
+def test_failed_refresh_surfaces_original_error():
+    def respond(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/api/auth/v1/refresh":
+            return httpx.Response(500, text="refresh failed")
+        return httpx.Response(401, text="unauthorized")
+
+    client, requests = _mock_client(respond, Tokens(_encode_test_token("user"), "refresh", None))
+
+    with pytest.raises(FetchException) as exec:
+        client.records("table").read(1)
+
+    assert exec.value.status == 401
+    assert exec.value.message == "unauthorized"
+    assert [r.url.path for r in requests] == ["/api/records/v1/table/1", "/api/auth/v1/refresh"]
+
+
 logger = logging.getLogger(__name__)
@@ -6,11 +6,24 @@ import httpx
 import jwt
 import logging
 import typing
-import json
+
+try:
+    import orjson as _json
+
+    _json_dumps = _json.dumps
+except ImportError:
+    import json as _json
+
+    def _json_dumps(obj: typing.Any, /) -> bytes:
+        # Produce the same compact UTF-8 bytes as orjson, ready to be sent as-is.
+        return _json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
 
 from abc import ABC, abstractmethod
 from enum import Enum
 from contextlib import contextmanager
+from functools import lru_cache
+from importlib.util import find_spec
 from time import time
 from typing import ContextManager, TypeAlias, cast, final
 
@@ -30,6 +43,8 @@ class FetchException(Exception):
 
 
 class RecordId:
+    __slots__ = ("id",)
+
     id: str
 
     def __init__(self, id: str):
@@ -39,18 +54,26 @@ class RecordId:
         return f"{self.id}"
 
 
+def _record_id_str(record_id: RecordId | str | int) -> str:
+    t = type(record_id)
+    if t is RecordId:
+        return cast(RecordId, record_id).id
+    if t is str:
+        return cast(str, record_id)
+    return str(record_id)
+
+
 def record_ids_from_json(json: JSON_OBJECT) -> list[RecordId]:
     ids = json["ids"]
     assert isinstance(ids, list)
+    assert all(isinstance(id, str) for id in ids)
 
-    def convert(value: JSON) -> RecordId:
-        assert isinstance(value, str)
-        return RecordId(value)
-
-    return list([convert(id) for id in ids])
+    return [RecordId(id) for id in cast(list[str], ids)]
 
 
 class User:
+    __slots__ = ("id", "email", "username")
+
     id: str
     email: str | None
     username: str | None
@@ -73,6 +96,8 @@ class User:
 
 
 class ListResponse:
+    __slots__ = ("cursor", "total_count", "records")
+
     cursor: str | None
     total_count: int | None
     records: list[JSON_OBJECT]
@@ -95,6 +120,8 @@ class ListResponse:
 
 
 class Tokens:
+    __slots__ = ("auth", "refresh", "csrf")
+
     auth: str
     refresh: str | None
     csrf: str | None
@@ -116,7 +143,7 @@ class Tokens:
         return Tokens(auth, refresh, csrf)
 
     def valid(self) -> bool:
-        claims = jwt.decode(self.auth, algorithms=["EdDSA"], options={"verify_signature": False})
+        claims = _decode_jwt(self.auth)
         return len(claims) > 0
 
 
@@ -134,6 +161,8 @@ class MultiFactorAuthToken:
 
 
 class JwtToken:
+    __slots__ = ("sub", "iat", "exp", "email", "username", "csrfToken")
+
     sub: str
     iat: int
     exp: int
@@ -170,20 +199,25 @@ class JwtToken:
 
 
 class TokenState:
+    __slots__ = ("state", "headers", "stream_headers")
+
     state: tuple[Tokens, JwtToken] | None
     headers: dict[str, str]
+    stream_headers: dict[str, str]
 
     def __init__(self, state: tuple[Tokens, JwtToken] | None, headers: dict[str, str]) -> None:
         self.state = state
         self.headers = headers
+        # Shared across requests, which is safe since httpx copies headers. Don't mutate.
+        self.stream_headers = {
+            **headers,
+            "Accept": "text/event-stream",
+            "Cache-Control": "no-store",
+        }
 
     @staticmethod
     def build(tokens: Tokens | None) -> "TokenState":
-        decoded = (
-            jwt.decode(tokens.auth, algorithms=["EdDSA"], options={"verify_signature": False})
-            if tokens is not None
-            else None
-        )
+        decoded = _decode_jwt(tokens.auth) if tokens is not None else None
 
         if decoded is None or tokens is None:
             return TokenState(None, TokenState.build_headers(tokens))
@@ -294,6 +328,7 @@ class Transport(ABC):
         query_params: dict[str, str] | None = None,
         body: JSON | None = None,
     ) -> httpx.Response:
+        """Send a request to `path`, which is relative to the site and must not start with "/"."""
         pass
 
     @abstractmethod
@@ -305,6 +340,11 @@ class Transport(ABC):
         query_params: dict[str, str] | None = None,
         timeout: httpx.Timeout | None = None,
     ) -> ContextManager[httpx.Response]:
+        """Stream a response from `path`, which is relative to the site and must not start with "/".
+
+        Implementations are expected to request an event stream, i.e. set "Accept: text/event-stream"
+        and "Cache-Control: no-store" unless `headers` already do.
+        """
         pass
 
 
@@ -313,8 +353,13 @@ class DefaultTransport(Transport):
     site: str
 
     def __init__(self, site: str, http_client: httpx.Client | None = None) -> None:
+        """Transport talking to `site` via `http_client`.
+
+        Defaults to a pooled keep-alive client, which negotiates HTTP/2 if the optional `h2` package
+        is installed (e.g. `pip install trailbase[http2]`). Pass your own `http_client` to override.
+        """
         self.site = site
-        self.http_client = http_client or httpx.Client()
+        self.http_client = http_client or _default_http_client()
 
     def fetch(
         self,
@@ -324,11 +369,18 @@ class DefaultTransport(Transport):
         query_params: dict[str, str] | None = None,
         body: JSON | None = None,
     ) -> httpx.Response:
-        assert not path.startswith("/")
+        # NOTE: We serialize the body ourselves rather than passing `json=` to skip httpx's stdlib
+        # encoder, thus we also have to set the "Content-Type" unless the caller already did.
+        content: bytes | None = None
+        if body is not None:
+            content = _json_dumps(body)
+            if headers is None or not _has_content_type(headers):
+                headers = {**(headers or {}), "Content-Type": "application/json"}
+
         return self.http_client.request(
             method=method or "GET",
             url=f"{self.site}/{path}",
-            json=body,
+            content=content,
             headers=headers,
             params=query_params,
         )
@@ -341,10 +393,8 @@ class DefaultTransport(Transport):
         query_params: dict[str, str] | None = None,
         timeout: httpx.Timeout | None = None,
     ) -> ContextManager[httpx.Response]:
-        assert not path.startswith("/")
-        headers = (headers or {}).copy()
-        headers["Accept"] = "text/event-stream"
-        headers["Cache-Control"] = "no-store"
+        if headers is None or "Accept" not in headers or "Cache-Control" not in headers:
+            headers = {"Accept": "text/event-stream", "Cache-Control": "no-store", **(headers or {})}
 
         request = self.http_client.build_request(
             method=method or "GET",
@@ -391,13 +441,7 @@ class Client:
     def user(self) -> User | None:
         tokens = self.tokens()
         if tokens is not None:
-            return User.from_json(
-                jwt.decode(
-                    tokens.auth,
-                    algorithms=["EdDSA"],
-                    options={"verify_signature": False},
-                )
-            )
+            return User.from_json(_decode_jwt(tokens.auth))
 
     def site(self) -> str:
         return self._site
@@ -414,11 +458,11 @@ class Client:
         )
 
         if response.status_code == 403:
-            return MultiFactorAuthToken.from_json(response.json())
+            return MultiFactorAuthToken.from_json(_json.loads(response.content))
         elif response.status_code > 200:
             raise FetchException(response.status_code, response.text)
 
-        self._set_token_state(TokenState.build(Tokens.from_json(response.json())))
+        self._set_token_state(TokenState.build(Tokens.from_json(_json.loads(response.content))))
 
         return None
 
@@ -432,7 +476,7 @@ class Client:
             },
         )
 
-        self._set_token_state(TokenState.build(Tokens.from_json(response.json())))
+        self._set_token_state(TokenState.build(Tokens.from_json(_json.loads(response.content))))
 
     def request_otp(self, email_or_username: str) -> None:
         self.fetch(
@@ -454,7 +498,7 @@ class Client:
             },
         )
 
-        self._set_token_state(TokenState.build(Tokens.from_json(response.json())))
+        self._set_token_state(TokenState.build(Tokens.from_json(_json.loads(response.content))))
 
     def login_anonymously(self) -> None:
         response = self.fetch(
@@ -463,7 +507,7 @@ class Client:
             data={},
         )
 
-        self._set_token_state(TokenState.build(Tokens.from_json(response.json())))
+        self._set_token_state(TokenState.build(Tokens.from_json(_json.loads(response.content))))
 
     def logout(self) -> None:
         state = self._token_state.state
@@ -548,6 +592,34 @@ class Client:
             path, method=method, headers=token_state.headers, query_params=query_params, body=data
         )
 
+        # The auth token may get rejected ahead of our proactive refresh, e.g. due to clock skew.
+        # Refresh once and retry rather than surfacing the error. Auth endpoints are excluded, since
+        # there a 401 means bad credentials and retrying would re-submit them, e.g. against the
+        # login rate limit.
+        state = token_state.state
+        refresh_token = state[0].refresh if state is not None else None
+        if (
+            response.status_code == 401
+            and refresh_token is not None
+            and not path.startswith(f"{_AUTH_API}/")
+        ):
+            try:
+                refreshed = _refresh_tokens_impl(self._transport, refresh_token)
+            except FetchException:
+                # Surface the original error rather than the refresh failure.
+                refreshed = None
+
+            if refreshed is not None:
+                token_state = self._set_token_state(refreshed)
+                if token_state.state is not None:
+                    response = self._transport.fetch(
+                        path,
+                        method=method,
+                        headers=token_state.headers,
+                        query_params=query_params,
+                        body=data,
+                    )
+
         if response.status_code > 200 and throwOnError:
             raise FetchException(response.status_code, response.text)
 
@@ -568,7 +640,7 @@ class Client:
         return self._transport.stream(
             path,
             method=method,
-            headers=token_state.headers,
+            headers=token_state.stream_headers,
             query_params=query_params,
             timeout=timeout,
         )
@@ -590,37 +662,30 @@ class CompareOp(Enum):
     IS_NOT_NULL = 13
 
     def __repr__(self) -> str:
-        match self:
-            case CompareOp.EQUAL:
-                return "$eq"
-            case CompareOp.NOT_EQUAL:
-                return "$ne"
-            case CompareOp.LESS_THAN:
-                return "$lt"
-            case CompareOp.LESS_THAN_EQUAL:
-                return "$lte"
-            case CompareOp.GREATER_THAN:
-                return "$gt"
-            case CompareOp.GREATER_THAN_EQUAL:
-                return "$gte"
-            case CompareOp.LIKE:
-                return "$like"
-            case CompareOp.REGEXP:
-                return "$re"
-            case CompareOp.ST_WITHIN:
-                return "@within"
-            case CompareOp.ST_INTERSECTS:
-                return "@intersects"
-            case CompareOp.ST_CONTAINS:
-                return "@contains"
-            case CompareOp.IS_NULL:
-                return "$is"
-            case CompareOp.IS_NOT_NULL:
-                return "$is"
+        return _COMPARE_OP_REPR[self]
+
+
+_COMPARE_OP_REPR: dict[CompareOp, str] = {
+    CompareOp.EQUAL: "$eq",
+    CompareOp.NOT_EQUAL: "$ne",
+    CompareOp.LESS_THAN: "$lt",
+    CompareOp.LESS_THAN_EQUAL: "$lte",
+    CompareOp.GREATER_THAN: "$gt",
+    CompareOp.GREATER_THAN_EQUAL: "$gte",
+    CompareOp.LIKE: "$like",
+    CompareOp.REGEXP: "$re",
+    CompareOp.ST_WITHIN: "@within",
+    CompareOp.ST_INTERSECTS: "@intersects",
+    CompareOp.ST_CONTAINS: "@contains",
+    CompareOp.IS_NULL: "$is",
+    CompareOp.IS_NOT_NULL: "$is",
+}
 
 
 @final
 class Filter:
+    __slots__ = ("column", "op", "value")
+
     column: str
     op: CompareOp | None
     value: str
@@ -671,10 +736,12 @@ class RecordApi:
 
     _name: str
     _client: Client
+    _path: str
 
     def __init__(self, name: str, client: Client) -> None:
         self._name = name
         self._client = client
+        self._path = f"{self._recordApi}/{name}"
 
     def list(
         self,
@@ -706,87 +773,125 @@ class RecordApi:
         if count:
             params["count"] = "true"
 
-        def traverse_filters(path: str, filter: FilterOrComposite):
-            match filter:
-                case Filter() as f:
-                    if f.op is not None:
-                        params[f"{path}[{f.column}][{repr(f.op)}]"] = f.value
-                    else:
-                        params[f"{path}[{f.column}]"] = f.value
-                case And() as f:
-                    for i, filter in enumerate(f.filters):
-                        traverse_filters(f"{path}[$and][{i}", filter)
-                case Or() as f:
-                    for i, filter in enumerate(f.filters):
-                        traverse_filters(f"{path}[$or][{i}", filter)
-
         if filters is not None:
-            for filter in filters:
-                traverse_filters("filter", filter)
-
-        response = self._client.fetch(f"{self._recordApi}/{self._name}", query_params=params)
-        return ListResponse.from_json(response.json())
+            # Children are pushed in reverse to emit params in declaration order.
+            stack: list[tuple[list[str], FilterOrComposite]] = [(["filter"], f) for f in reversed(filters)]
+            while stack:
+                path, filter = stack.pop()
+                match filter:
+                    case Filter() as f:
+                        if f.op is not None:
+                            params["".join(path + ["[", f.column, "][", repr(f.op), "]"])] = f.value
+                        else:
+                            params["".join(path + ["[", f.column, "]"])] = f.value
+                    case And() as f:
+                        for i in range(len(f.filters) - 1, -1, -1):
+                            stack.append((path + ["[$and][", str(i), "]"], f.filters[i]))
+                    case Or() as f:
+                        for i in range(len(f.filters) - 1, -1, -1):
+                            stack.append((path + ["[$or][", str(i), "]"], f.filters[i]))
+
+        response = self._client.fetch(self._path, query_params=params)
+        return ListResponse.from_json(_json.loads(response.content))
 
     def read(
         self,
         record_id: RecordId | str | int,
         expand: "list[str] | None" = None,
     ) -> JSON_OBJECT:
-        id = repr(record_id) if isinstance(record_id, RecordId) else f"{record_id}"
+        id = _record_id_str(record_id)
         params = {"expand": ",".join(expand)} if expand is not None else None
 
-        return self._client.fetch(
-            f"{self._recordApi}/{self._name}/{id}",
+        response = self._client.fetch(
+            f"{self._path}/{id}",
             query_params=params,
-        ).json()
+        )
+        return _json.loads(response.content)
+
+    def read_many(
+        self,
+        record_ids: "list[RecordId | str | int]",
+        expand: "list[str] | None" = None,
+        id_column: str = "id",
+    ) -> "list[JSON_OBJECT]":
+        """Read multiple records in a single round-trip.
+
+        Issues one `list` query matching `id_column` against any of `record_ids` and returns the
+        found records in input order. Records that don't exist or aren't accessible are omitted.
+        Raises `FetchException` if the number of distinct ids exceeds the server's listing limit
+        (1024 by default).
+        """
+        if len(record_ids) == 0:
+            return []
+
+        ids = [_record_id_str(r) for r in record_ids]
+        unique = list(dict.fromkeys(ids))
+        response = self.list(
+            filters=[Or([Filter(id_column, id) for id in unique])],
+            expand=expand,
+            limit=len(unique),
+        )
+
+        by_id = {f"{record.get(id_column)}": record for record in response.records}
+        return [record for id in ids if (record := by_id.get(id)) is not None]
 
     def create(self, record: JSON_OBJECT) -> RecordId:
         response = self._client.fetch(
-            f"{self._recordApi}/{self._name}",
+            self._path,
             method="POST",
             data=record,
         )
-        return record_ids_from_json(response.json())[0]
+        return record_ids_from_json(_json.loads(response.content))[0]
 
     def create_bulk(self, records: JSON_ARRAY):
         response = self._client.fetch(
-            f"{self._recordApi}/{self._name}",
+            self._path,
             method="POST",
             data=records,
         )
-        return record_ids_from_json(response.json())
+        return record_ids_from_json(_json.loads(response.content))
 
     def update(self, record_id: RecordId | str | int, record: JSON_OBJECT) -> None:
-        id = repr(record_id) if isinstance(record_id, RecordId) else f"{record_id}"
+        id = _record_id_str(record_id)
         self._client.fetch(
-            f"{self._recordApi}/{self._name}/{id}",
+            f"{self._path}/{id}",
             method="PATCH",
             data=record,
         )
 
     def delete(self, record_id: RecordId | str | int) -> None:
-        id = repr(record_id) if isinstance(record_id, RecordId) else f"{record_id}"
+        id = _record_id_str(record_id)
         self._client.fetch(
-            f"{self._recordApi}/{self._name}/{id}",
+            f"{self._path}/{id}",
             method="DELETE",
         )
 
     def subscribe(self, record_id: RecordId | str | int) -> typing.Generator[EVENT]:
-        id = repr(record_id) if isinstance(record_id, RecordId) else f"{record_id}"
-        context = self._client.stream(
-            f"{self._recordApi}/{self._name}/subscribe/{id}", timeout=httpx.Timeout(None)
-        )
+        id = _record_id_str(record_id)
+        context = self._client.stream(f"{self._path}/subscribe/{id}", timeout=httpx.Timeout(None))
 
         def impl() -> typing.Generator[EVENT]:
             with context as response:
                 if response.status_code > 200:
+                    # Streamed responses need to be read explicitly before accessing `text`.
+                    response.read()
                     raise FetchException(response.status_code, response.text)
 
-                for line in response.iter_lines():
-                    if line.startswith("data: "):
-                        ev = parseEvent(json.loads(line.rstrip("\n")[6:]))
-                        if ev is not None:
-                            yield ev
+                # A trailing "\r" from CRLF line endings is JSON whitespace and thus harmless.
+                buf = bytearray()
+                for chunk in response.iter_bytes():
+                    buf += chunk
+
+                    start = 0
+                    while (end := buf.find(b"\n", start)) != -1:
+                        if buf.startswith(b"data: ", start):
+                            payload = start + 6
+                            ev = parseEvent(_json.loads(buf[payload:end]))
+                            if ev is not None:
+                                yield ev
+                        start = end + 1
+
+                    del buf[:start]
 
         return impl()
 
@@ -808,7 +913,7 @@ def _refresh_tokens_impl(transport: Transport, refresh_token: str) -> TokenState
 
     match response.status_code:
         case 200:
-            from_json = Tokens.from_json(response.json())
+            from_json = Tokens.from_json(_json.loads(response.content))
             return TokenState.build(Tokens(from_json.auth, refresh_token, from_json.csrf))
         case 401:
             # Refresh token was rejected w/o means to recover. May as well log out.
@@ -817,5 +922,24 @@ def _refresh_tokens_impl(transport: Transport, refresh_token: str) -> TokenState
             raise FetchException(response.status_code, response.text)
 
 
+def _has_content_type(headers: dict[str, str]) -> bool:
+    return "Content-Type" in headers or any(k.lower() == "content-type" for k in headers)
+
+
+def _default_http_client() -> httpx.Client:
+    return httpx.Client(
+        http2=find_spec("h2") is not None,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=30.0),
+        timeout=httpx.Timeout(10.0, connect=5.0),
+    )
+
+
+@lru_cache(maxsize=128)
+def _decode_jwt(auth: str) -> JSON_OBJECT:
+    # NOTE: The signature isn't verified, so this is a pure parse of claims that are immutable for the
+    # token's lifetime and safe to cache. Callers must not mutate the returned claims.
+    return jwt.decode(auth, algorithms=["EdDSA"], options={"verify_signature": False})
+
+
 _logger = logging.getLogger(__name__)
 _AUTH_API: str = "api/auth/v1"